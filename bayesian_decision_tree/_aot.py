@@ -0,0 +1,30 @@
+"""
+Ahead-of-time compilation of the kernels called directly from Python into the extension module
+`bayesian_decision_tree._aot_kernels`, which `kernels` picks up if it has been built. This avoids the
+JIT compilation (or cache loading) on first use in short-lived processes.
+
+The extension is built by `python setup.py build_ext` or by running this module directly.
+
+Only kernels with fixed argument types are compiled ahead of time. The split search kernels are
+parallel and generic in the index type, and `predict_leaves` has to release the GIL for multi-threaded
+prediction, neither of which is supported by AOT compilation, so these are always jitted.
+"""
+import os
+
+from numba.pycc import CC
+
+from bayesian_decision_tree import kernels
+
+cc = CC('_aot_kernels')
+cc.output_dir = os.path.dirname(os.path.abspath(__file__))
+
+cc.export('find_split_indices', 'i8(f8[:], i8[:])')(kernels._find_split_indices.py_func)
+cc.export('log_p_data_split_regression', 'f8[:](f8[:], i8[:], f8[:], f8)')(
+    kernels._log_p_data_split_regression_all.py_func)
+cc.export('log_p_data_split_classification', 'f8[:](f8[:], i8[:], f8[:], f8)')(
+    kernels._log_p_data_split_classification_all.py_func)
+cc.export('has_different_values', 'b1(f8[:])')(kernels._has_different_values.py_func)
+
+
+if __name__ == '__main__':
+    cc.compile()
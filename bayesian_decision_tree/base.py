@@ -1,10 +1,23 @@
+import numbers
+import os
 from abc import ABC, abstractmethod
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
 
 import numpy as np
 import pandas as pd
 from scipy.sparse import csr_matrix, csc_matrix
 from sklearn.base import BaseEstimator
 
+# prediction batches smaller than this are not worth being split up across threads
+PARALLEL_PREDICTION_MIN_ROWS = 4096
+
+
+@lru_cache(maxsize=16)
+def _default_feature_names(n_dim):
+    # 'x0', 'x1', ..., shared between calls, hence immutable
+    return tuple('x{}'.format(i) for i in range(n_dim))
+
 
 class BaseTree(ABC, BaseEstimator):
     """
@@ -31,7 +44,7 @@ class BaseTree(ABC, BaseEstimator):
         self.n_data = None
         self._erase_split_info_base()
 
-    def fit(self, X, y, delta=0.0, prune=False, verbose=False, feature_names=None):
+    def fit(self, X, y, delta=0.0, prune=False, verbose=False, feature_names=None, n_jobs=1, max_bins=None):
         """
         Trains this classification or regression tree using the training set (X, y).
 
@@ -65,6 +78,21 @@ class BaseTree(ABC, BaseEstimator):
             An optional sequence of feature names. If not provided then 'x0', 'x1', ... is used
             if X is a matrix, or the column headers if X is a DataFrame.
 
+        n_jobs : int or None, default=1
+            The number of threads to fit independent subtrees of perpendicular trees with, -1 means
+            using all processors, None means 1. Only subtrees of at least 10000 samples are handed
+            off to another thread. Hyperplane trees are always fitted on a single thread, and so are
+            perpendicular trees (with a warning) if Numba's threading layer is 'workqueue', which
+            can't run the parallel split search from multiple threads at once (install TBB or
+            OpenMP to avoid this).
+
+        max_bins : int, default=None
+            If set, perpendicular trees only consider splits between the (at most) `max_bins`
+            quantile bins of each feature rather than between all different feature values, which
+            speeds up fitting on large data sets at the expense of (usually slightly) coarser splits.
+            Must be between 2 and 65536. Only applies to dense data matrices, hyperplane trees
+            ignore it.
+
         References
         ----------
 
@@ -82,19 +110,30 @@ class BaseTree(ABC, BaseEstimator):
         if delta < 0.0 or delta > 1.0:
             raise ValueError('Delta must be between 0.0 and 1.0 but was {}.'.format(delta))
 
+        n_jobs = self._get_n_jobs(n_jobs)
+
+        if max_bins is not None and (
+                not isinstance(max_bins, numbers.Integral) or isinstance(max_bins, bool)
+                or max_bins < 2 or max_bins > (1 << 16)):
+            raise ValueError('max_bins must be an integer between 2 and 65536 but was {}.'.format(max_bins))
+
         X, feature_names = self._normalize_data_and_feature_names(X, feature_names)
         if X.shape[0] != len(y):
             raise ValueError('Invalid shapes: X={}, y={}'.format(X.shape, y.shape))
 
-        # fit
-        self._fit(X, y, delta, verbose, feature_names, 'root')
+        # fit (from scratch, forgetting the splits of any previous fit)
+        self._erase_split_info_base()
+        self._erase_split_info()
+        self._fit(X, y, delta, verbose, feature_names, 'root', n_jobs, max_bins)
 
         if prune:
             self._prune()
 
+        self._compile()
+
         return self
 
-    def predict(self, X):
+    def predict(self, X, n_jobs=1):
         """Predict class or regression value for X.
 
         For a classification model, the predicted class for each sample in X is
@@ -106,6 +145,10 @@ class BaseTree(ABC, BaseEstimator):
         X : array-like, scipy.sparse.csc_matrix, scipy.sparse.csr_matrix, pandas.DataFrame or pandas.SparseDataFrame, shape = [n_samples, n_features]
             The input samples.
 
+        n_jobs : int or None, default=1
+            The number of threads to predict with, -1 means using all processors, None means 1. Only
+            batches of at least 4096 samples are split up.
+
         Returns
         -------
         y : array of shape = [n_samples]
@@ -116,7 +159,7 @@ class BaseTree(ABC, BaseEstimator):
         X, _ = self._normalize_data_and_feature_names(X)
         self._ensure_is_fitted(X)
 
-        prediction = self._predict(X, predict_class=True)
+        prediction = self._predict_in_chunks(X, True, n_jobs)
         if not isinstance(prediction, np.ndarray):
             # if the tree consists of a single leaf only then we have to cast that single float back to an array
             prediction = self._create_merged_predictions_array(X, True, prediction)
@@ -144,12 +187,40 @@ class BaseTree(ABC, BaseEstimator):
 
         return feature_importance
 
+    def _predict_in_chunks(self, X, predict_class, n_jobs):
+        n_jobs = self._get_n_jobs(n_jobs)
+        n_rows = X.shape[0]
+        if n_jobs == 1 or n_rows < PARALLEL_PREDICTION_MIN_ROWS:
+            return self._predict(X, predict_class)
+
+        # the fitted tree is read-only during prediction, so contiguous blocks of rows can be predicted concurrently
+        # (at least one row per block as the recursive prediction of an empty block doesn't return an array)
+        n_jobs = min(n_jobs, n_rows)
+        bounds = np.linspace(0, n_rows, n_jobs+1).astype(int)
+        with ThreadPoolExecutor(max_workers=n_jobs) as executor:
+            predictions = list(executor.map(
+                lambda start_end: self._predict(X[start_end[0]:start_end[1]], predict_class),
+                zip(bounds[:-1], bounds[1:])))
+
+        return np.concatenate(predictions)
+
+    @staticmethod
+    def _get_n_jobs(n_jobs):
+        # None means 1, as in scikit-learn
+        if n_jobs is None:
+            return 1
+
+        if n_jobs == -1:
+            return os.cpu_count() or 1
+
+        if not isinstance(n_jobs, numbers.Integral) or isinstance(n_jobs, bool) or n_jobs < 1:
+            raise ValueError('n_jobs must be -1 or a positive integer but was {}.'.format(n_jobs))
+
+        return int(n_jobs)
+
     def _predict(self, X, predict_class):
         if self.is_leaf():
-            prediction = self._predict_leaf() if predict_class else self._compute_posterior_mean().reshape(1, -1)
-            predictions = self._create_merged_predictions_array(X, predict_class, prediction)
-            predictions[:] = prediction
-            return predictions
+            return self._create_leaf_predictions_array(X, predict_class)
         else:
             dense = isinstance(X, np.ndarray)
             if not dense and isinstance(X, csr_matrix):
@@ -181,21 +252,15 @@ class BaseTree(ABC, BaseEstimator):
         if self.is_leaf():
             return
 
-        depth_start = self.get_depth()
-        n_leaves_start = self.get_n_leaves()
+        # prune bottom-up so that by the time we get here both children are pruned as far as possible
+        self.child1._prune()
+        self.child2._prune()
 
         if self.child1.is_leaf() and self.child2.is_leaf():
             if self.child1._predict_leaf() == self.child2._predict_leaf():
                 # same prediction (class if classification, value if regression) -> no need to split
                 self._erase_split_info_base()
                 self._erase_split_info()
-        else:
-            self.child1._prune()
-            self.child2._prune()
-
-        if depth_start != self.get_depth() or n_leaves_start != self.get_n_leaves():
-            # we did some pruning somewhere down this sub-tree -> prune again
-            self._prune()
 
     @abstractmethod
     def _update_feature_importance(self, feature_importance):
@@ -203,6 +268,13 @@ class BaseTree(ABC, BaseEstimator):
 
     @staticmethod
     def _normalize_data_and_feature_names(X, feature_names=None):
+        if type(X) is np.ndarray and X.dtype == np.float64 and X.ndim == 2:
+            # fast path for the most common case, nothing to convert
+            if feature_names is None:
+                feature_names = _default_feature_names(X.shape[1])
+
+            return X, feature_names
+
         if isinstance(X, pd.SparseDataFrame):
             # we cannot directly access the sparse underlying data,
             # but we can convert it to a sparse scipy matrix
@@ -225,7 +297,7 @@ class BaseTree(ABC, BaseEstimator):
                 X = np.expand_dims(X, 0)
 
             if feature_names is None:
-                feature_names = ['x{}'.format(i) for i in range(X.shape[1])]
+                feature_names = _default_feature_names(X.shape[1])
 
         X = BaseTree._ensure_float64(X)
 
@@ -236,6 +308,10 @@ class BaseTree(ABC, BaseEstimator):
 
     @staticmethod
     def _ensure_float64(data):
+        if data.dtype == np.float64:
+            # by far the most common case, skip the dtype scan below
+            return data
+
         if data.dtype in (
                 np.int8, np.int16, np.int32, np.int64,
                 np.uint8, np.uint16, np.uint32, np.uint64,
@@ -256,6 +332,12 @@ class BaseTree(ABC, BaseEstimator):
         if X is not None and X.shape[1] != self.n_dim:
             raise ValueError('Bad input dimensions: Expected {}, got {}'.format(self.n_dim, X.shape[1]))
 
+    def _create_leaf_predictions_array(self, X, predict_class):
+        prediction = self._predict_leaf() if predict_class else self._compute_posterior_mean().reshape(1, -1)
+        predictions = self._create_merged_predictions_array(X, predict_class, prediction)
+        predictions[:] = prediction
+        return predictions
+
     @staticmethod
     def _create_merged_predictions_array(X, predict_class, predictions_child):
         # class predictions: 1D array
@@ -272,7 +354,7 @@ class BaseTree(ABC, BaseEstimator):
             The tree depth.
         """
 
-        return self._update_depth(0)
+        return max(node.level for node in self._get_nodes() if node.is_leaf())
 
     def get_n_leaves(self):
         """Computes and returns the total number of leaves of this tree.
@@ -283,27 +365,19 @@ class BaseTree(ABC, BaseEstimator):
             The number of leaves.
         """
 
-        return self._update_n_leaves(0)
+        return sum(1 for node in self._get_nodes() if node.is_leaf())
 
-    def _update_depth(self, depth):
-        if self.is_leaf():
-            return max(depth, self.level)
-        else:
-            if self.child1 is not None:
-                depth = self.child1._update_depth(depth)
-                depth = self.child2._update_depth(depth)
-
-            return depth
-
-    def _update_n_leaves(self, n_leaves):
-        if self.is_leaf():
-            return n_leaves+1
-        else:
-            if self.child1 is not None:
-                n_leaves = self.child1._update_n_leaves(n_leaves)
-                n_leaves = self.child2._update_n_leaves(n_leaves)
+    def _get_nodes(self):
+        # all nodes of this tree in depth-first order, collected without recursion
+        nodes = []
+        stack = [self]
+        while stack:
+            node = stack.pop()
+            nodes.append(node)
+            if not node.is_leaf():
+                stack += [node.child2, node.child1]
 
-            return n_leaves
+        return nodes
 
     def _erase_split_info_base(self):
         self.child1 = None
@@ -315,6 +389,10 @@ class BaseTree(ABC, BaseEstimator):
     def _erase_split_info(self):
         pass
 
+    @abstractmethod
+    def _compile(self):
+        pass
+
     @abstractmethod
     def is_leaf(self):
         pass
@@ -331,10 +409,18 @@ class BaseTree(ABC, BaseEstimator):
     def _compute_log_p_data_split(self, y, split_indices, n_dim):
         pass
 
+    @abstractmethod
+    def _find_best_split(self, X, y, sort_indices_by_dim, n_dim, in_node):
+        pass
+
     @abstractmethod
     def _compute_posterior(self, y, delta=1):
         pass
 
+    @abstractmethod
+    def _combine_posteriors(self, posterior1, posterior2, n_data1, n_data2):
+        pass
+
     @abstractmethod
     def _compute_posterior_mean(self):
         pass
@@ -344,7 +430,7 @@ class BaseTree(ABC, BaseEstimator):
         pass
 
     @abstractmethod
-    def _fit(self, X, y, delta, verbose, feature_names, side_name):
+    def _fit(self, X, y, delta, verbose, feature_names, side_name, n_jobs=1, max_bins=None):
         pass
 
     def __repr__(self):
@@ -6,6 +6,7 @@ from scipy.sparse import csc_matrix, csr_matrix
 
 from bayesian_decision_tree.base import BaseTree
 from bayesian_decision_tree.hyperplane_optimization import HyperplaneOptimizationFunction, ScipyOptimizer
+from bayesian_decision_tree.kernels import has_different_values
 
 
 class BaseHyperplaneTree(BaseTree, ABC):
@@ -26,7 +27,9 @@ class BaseHyperplaneTree(BaseTree, ABC):
 
         self._erase_split_info()
 
-    def _fit(self, X, y, delta, verbose, feature_names, side_name):
+    def _fit(self, X, y, delta, verbose, feature_names, side_name, n_jobs=1, max_bins=None):
+        # the kernels expect float64 targets, so convert them once here rather than at every kernel call
+        y = np.ascontiguousarray(y, dtype=np.float64)
         n_data = X.shape[0]
 
         if verbose:
@@ -54,6 +57,7 @@ class BaseHyperplaneTree(BaseTree, ABC):
         self.optimization_function = optimization_function
 
         # retrieve best hyperplane split from optimization function
+        is_split = False
         if optimization_function.best_hyperplane_normal is not None:
             # split data and target to recursively train children
             projections = X @ optimization_function.best_hyperplane_normal \
@@ -90,16 +94,17 @@ class BaseHyperplaneTree(BaseTree, ABC):
 
                 self.child1 = self.child_type(self.partition_prior, prior_child1, self.optimizer, self.level + 1)
                 self.child2 = self.child_type(self.partition_prior, prior_child2, self.optimizer, self.level + 1)
+                is_split = True
 
                 # fit children if there is more than one data point (i.e., there is
                 # something to split) and if the targets differ (no point otherwise)
-                if n_data1 > 1 and len(np.unique(y1)) > 1:
+                if n_data1 > 1 and has_different_values(y1):
                     self.child1._fit(X1, y1, delta, verbose, feature_names, 'back ')
                 else:
                     self.child1.posterior = self._compute_posterior(y1)
                     self.child1.n_data = n_data1
 
-                if n_data2 > 1 and len(np.unique(y2)) > 1:
+                if n_data2 > 1 and has_different_values(y2):
                     self.child2._fit(X2, y2, delta, verbose, feature_names, 'front')
                 else:
                     self.child2.posterior = self._compute_posterior(y2)
@@ -108,12 +113,18 @@ class BaseHyperplaneTree(BaseTree, ABC):
         # compute posterior
         self.n_dim = X.shape[1]
         self.n_data = n_data
-        self.posterior = self._compute_posterior(y)
+        if is_split:
+            # the children share this node's prior, so there's no need to go through the data again
+            self.posterior = self._combine_posteriors(
+                self.child1.posterior, self.child2.posterior, self.child1.n_data, self.child2.n_data)
+        else:
+            self.posterior = self._compute_posterior(y)
 
     def _compute_child1_and_child2_indices(self, X, dense):
         projections = X @ self.best_hyperplane_normal - np.dot(self.best_hyperplane_normal, self.best_hyperplane_origin)
-        indices1 = np.where(projections < 0)[0]
-        indices2 = np.where(projections >= 0)[0]
+        is_child1 = projections < 0
+        indices1 = np.flatnonzero(is_child1)
+        indices2 = np.flatnonzero(~is_child1)
 
         return indices1, indices2
 
@@ -148,6 +159,10 @@ class BaseHyperplaneTree(BaseTree, ABC):
         self.best_hyperplane_normal = None
         self.best_hyperplane_origin = None
 
+    def _compile(self):
+        # hyperplane trees are always predicted recursively
+        pass
+
     def __str__(self):
         if self.posterior is None:
             return 'Unfitted model'
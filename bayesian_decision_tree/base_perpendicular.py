@@ -1,9 +1,27 @@
+import threading
+import warnings
 from abc import ABC
+from collections import deque, namedtuple
+from concurrent.futures import ThreadPoolExecutor
 
 import numpy as np
+from numba import threading_layer
 from scipy.sparse import csr_matrix, csc_matrix
 
 from bayesian_decision_tree.base import BaseTree
+from bayesian_decision_tree.kernels import has_different_values, partition_sort_indices, predict_leaves
+
+# subtrees with fewer data points than this are fitted on the thread that created them rather than handed off
+PARALLEL_FIT_MIN_ROWS = 10000
+
+# a node that still needs to be fitted, along with the sort indices of its training data
+NodeTask = namedtuple('NodeTask', ['node', 'side_name', 'sort_indices_by_dim'])
+
+# a fitted tree flattened into parallel arrays indexed by node (in breadth-first order, root = 0, leaves
+# have child1 = child2 = -1), along with the per-node predictions, posterior means (classification only)
+# and prediction paths (leaves only)
+FlatTree = namedtuple(
+    'FlatTree', ['split_dimension', 'split_value', 'child1', 'child2', 'prediction', 'posterior_mean', 'path'])
 
 
 class BasePerpendicularTree(BaseTree, ABC):
@@ -17,6 +35,7 @@ class BasePerpendicularTree(BaseTree, ABC):
         BaseTree.__init__(self, partition_prior, prior, child_type, is_regression, level)
 
         self._erase_split_info()
+        self._flat_tree = None
 
     def prediction_paths(self, X):
         """Returns the prediction paths for X.
@@ -40,13 +59,24 @@ class BasePerpendicularTree(BaseTree, ABC):
         X, _ = self._normalize_data_and_feature_names(X)
         self._ensure_is_fitted(X)
 
-        paths = [[] for i in range(X.shape[0])]
-        self._update_prediction_paths(X, paths)
+        # models pickled with version 0.2 or earlier don't have a flattened tree
+        flat_tree = getattr(self, '_flat_tree', None)
+        if isinstance(X, np.ndarray) and flat_tree is not None:
+            # look up the path of each row's leaf rather than assembling the paths while descending the tree
+            leaves = predict_leaves(X, flat_tree.split_dimension, flat_tree.split_value, flat_tree.child1, flat_tree.child2)
+            return [list(flat_tree.path[leaf]) for leaf in leaves.tolist()]
+
+        paths = [None] * X.shape[0]
+        self._update_prediction_paths(X, np.arange(X.shape[0]), (), paths)
 
         return paths
 
-    def _update_prediction_paths(self, X, paths):
-        if not self.is_leaf():
+    def _update_prediction_paths(self, X, rows, path, paths):
+        if self.is_leaf():
+            # all rows ending up in this leaf share the same path, so only assemble the lists here
+            for i in rows.tolist():
+                paths[i] = list(path)
+        else:
             dense = isinstance(X, np.ndarray)
             if not dense and isinstance(X, csr_matrix):
                 # column accesses coming up, so convert to CSC sparse matrix format
@@ -56,108 +86,211 @@ class BasePerpendicularTree(BaseTree, ABC):
 
             if len(indices1) > 0:
                 step = (self.split_dimension, self.split_feature_name, self.split_value, False)
-                for i in indices1:
-                    paths[i].append(step)
+                self.child1._update_prediction_paths(X[indices1], rows[indices1], path + (step,), paths)
 
             if len(indices2) > 0:
                 step = (self.split_dimension, self.split_feature_name, self.split_value, True)
-                for i in indices2:
-                    paths[i].append(step)
-
-            if len(indices1) > 0 and not self.child1.is_leaf():
-                X1 = X[indices1]
-                paths1 = [paths[i] for i in indices1]
-                self.child1._update_prediction_paths(X1, paths1)
-
-            if len(indices2) > 0 and not self.child2.is_leaf():
-                X2 = X[indices2]
-                paths2 = [paths[i] for i in indices2]
-                self.child2._update_prediction_paths(X2, paths2)
+                self.child2._update_prediction_paths(X[indices2], rows[indices2], path + (step,), paths)
 
     @staticmethod
     def _create_merged_paths_array(n_rows):
         return np.zeros((n_rows, 4))
 
-    def _fit(self, X, y, delta, verbose, feature_names, side_name, sort_indices_by_dim=None):
-        n_data = sort_indices_by_dim.shape[1] if sort_indices_by_dim is not None else X.shape[0]
-
-        if verbose:
-            name = 'level {} {}'.format(self.level, side_name)
-            print('Training {} with {:10} data points'.format(name, n_data))
+    def _fit(self, X, y, delta, verbose, feature_names, side_name, n_jobs=1, max_bins=None):
+        # the split search gathers targets by data index, so store them contiguously and in a single dtype
+        y = np.ascontiguousarray(y, dtype=np.float64)
 
         dense = isinstance(X, np.ndarray)
-        if not dense and isinstance(X, csr_matrix):
+        if dense:
+            # the split search reads X one column at a time, so store the columns contiguously
+            X = np.asfortranarray(X)
+        else:
             # column accesses coming up, so convert to CSC sparse matrix format
+            # in canonical format (sorted indices without duplicates)
             X = csc_matrix(X)
+            if not X.has_canonical_format:
+                X = X.copy()
+                X.sum_duplicates()
+
+        # dimensions along which all data points have the same value can't be split at any node, so leave them
+        # out of the split search altogether (common with sparse data), keeping track of the original dimensions
+        n_data, n_dim = X.shape
+        if dense:
+            dims = np.flatnonzero(X.min(axis=0) != X.max(axis=0))
+        else:
+            dims = np.flatnonzero(X.min(axis=0).toarray().ravel() != X.max(axis=0).toarray().ravel())
 
-        n_dim = X.shape[1]
+        if len(dims) == 0:
+            self.n_dim = n_dim
+            self.n_data = n_data
+            self.posterior = self._compute_posterior(y)
+            return
+
+        if len(dims) < n_dim:
+            X = X[:, dims]
+            if dense:
+                X = np.asfortranarray(X)
 
         # compute sort indices (only done once at the start)
-        if sort_indices_by_dim is None:
-            dtype = np.uint16 if n_data < (1 << 16) else np.uint32 if n_data < (1 << 32) else np.uint64
-            sort_indices_by_dim = np.zeros(X.shape[::-1], dtype=dtype)
-            for dim in range(n_dim):
-                X_dim = X[:, dim]
-                if not dense:
-                    X_dim = self._to_array(X_dim)
+        dtype = np.uint16 if n_data < (1 << 16) else np.uint32 if n_data < (1 << 32) else np.uint64
+        sort_indices_by_dim = np.zeros((len(dims), n_data), dtype=dtype)
+        for dim in range(len(dims)):
+            X_dim = X[:, dim]
+            if not dense:
+                X_dim = self._to_array(X_dim)
+
+            sort_indices_by_dim[dim] = np.argsort(X_dim)
+
+        # the split search only needs the order of the values, so it can just as well run on bin numbers (which
+        # yields fewer candidate splits), whereas the split values are always computed from the original data
+        X_search = self._bin(X, max_bins) if max_bins is not None and dense else X
+
+        # scratch array marking the data points going to the LHS child of the node being split, shared by all nodes
+        # (each node only ever sets and then clears the entries of its own data points)
+        active1 = np.zeros(n_data, dtype=np.uint8)
+
+        # scratch arrays marking the data points of the node being searched for sparse splits, one per thread (created
+        # on first use) rather than shared as the search reads the entries of all data points, not only the node's
+        in_node_by_thread = None if dense else threading.local()
+
+        # fit the root, then its descendants, on multiple threads if requested (and possible)
+        fit_args = (X, X_search, y, dims, n_dim, delta, verbose, feature_names, active1, in_node_by_thread)
+        child_tasks = self._fit_node(*fit_args, side_name, sort_indices_by_dim)
+        if n_jobs != 1 and not self._can_fit_concurrently():
+            warnings.warn("Ignoring n_jobs={} and fitting on a single thread because Numba's 'workqueue' threading "
+                          "layer doesn't support concurrent calls of parallel kernels".format(n_jobs), RuntimeWarning)
+            n_jobs = 1
+
+        if n_jobs == 1:
+            for task in child_tasks:
+                self._fit_subtree(task, fit_args, None)
+        else:
+            with ThreadPoolExecutor(max_workers=n_jobs) as executor:
+                futures = deque(executor.submit(self._fit_subtree, task, fit_args, executor) for task in child_tasks)
+                while futures:
+                    futures.extend(futures.popleft().result())
+
+        if delta == 0:
+            # all nodes share the same prior, so the posteriors of split nodes follow from those of their
+            # children (bottom-up, i.e., in reverse depth-first order) without going through the data again
+            split_nodes = []
+            stack = [self]
+            while stack:
+                node = stack.pop()
+                if node.split_value is not None:
+                    split_nodes.append(node)
+                    stack += [node.child2, node.child1]
+
+            for node in reversed(split_nodes):
+                node.posterior = node._combine_posteriors(
+                    node.child1.posterior, node.child2.posterior, node.child1.n_data, node.child2.n_data)
+
+    @staticmethod
+    def _fit_subtree(task, fit_args, executor):
+        # trains the task's node and its descendants depth-first (LHS before RHS) using an explicit work queue
+        # rather than recursion, except for large enough subtrees which are handed off to the executor (if any)
+        # and whose futures are returned
+        futures = []
+        queue = deque([task])
+        while queue:
+            task = queue.pop()
+            child_tasks = task.node._fit_node(*fit_args, task.side_name, task.sort_indices_by_dim)
+            for child_task in reversed(child_tasks):
+                if executor is not None and child_task.sort_indices_by_dim.shape[1] >= PARALLEL_FIT_MIN_ROWS:
+                    futures.append(executor.submit(BasePerpendicularTree._fit_subtree, child_task, fit_args, executor))
+                else:
+                    queue.append(child_task)
+
+        return futures
+
+    @staticmethod
+    def _bin(X, max_bins):
+        # replaces the values of each dimension by their (order-preserving) bin numbers, where the bin edges
+        # are the dimension's quantiles if it has more than 'max_bins' different values
+        X_binned = np.empty(X.shape, dtype=np.uint8 if max_bins <= (1 << 8) else np.uint16, order='F')
+        for dim in range(X.shape[1]):
+            X_dim = X[:, dim]
+            values = np.unique(X_dim)
+            if len(values) <= max_bins:
+                X_binned[:, dim] = np.searchsorted(values, X_dim)
+            else:
+                bin_edges = np.quantile(X_dim, np.linspace(0, 1, max_bins+1)[1:-1])
+                X_binned[:, dim] = np.searchsorted(bin_edges, X_dim, side='right')
+
+        return X_binned
+
+    @staticmethod
+    def _can_fit_concurrently():
+        # the split search kernels are parallelized themselves, and Numba's 'workqueue' threading layer (the
+        # fallback if neither TBB nor OpenMP is available) can't run them from multiple threads at once
+        try:
+            return threading_layer() != 'workqueue'
+        except ValueError:
+            # no parallel kernel has been run yet
+            return False
+
+    def _fit_node(self, X, X_search, y, dims, n_dim, delta, verbose, feature_names, active1, in_node_by_thread,
+                  side_name, sort_indices_by_dim):
+        # finds the best split of this node and returns the tasks for fitting those of
+        # its children that have something left to split (X only contains the splittable
+        # dimensions 'dims' out of all 'n_dim' dimensions, and X_search is either X or
+        # its binned version, see _fit())
+        n_data = sort_indices_by_dim.shape[1]
+
+        if verbose:
+            name = 'level {} {}'.format(self.level, side_name)
+            print('Training {} with {:10} data points'.format(name, n_data))
 
-                sort_indices_by_dim[dim] = np.argsort(X_dim)
+        # gather this node's targets once (any dim works as the order doesn't matter)
+        y_node = y[sort_indices_by_dim[0]]
 
         # compute data likelihood of not splitting and remember it as the best option so far
-        log_p_data_no_split = self._compute_log_p_data_no_split(y[sort_indices_by_dim[0]])  # any dim works as the order doesn't matter
+        log_p_data_no_split = self._compute_log_p_data_no_split(y_node)
         best_log_p_data_split = log_p_data_no_split
 
+        # this thread's scratch array for the sparse split search, see _fit()
+        in_node = None
+        if in_node_by_thread is not None:
+            if not hasattr(in_node_by_thread, 'in_node'):
+                in_node_by_thread.in_node = np.zeros(len(y), dtype=np.uint8)
+
+            in_node = in_node_by_thread.in_node
+
         # compute data likelihoods of all possible splits along all data dimensions
         best_split_index = -1       # index of best split
         best_split_dimension = -1   # dimension of best split
-        for dim in range(n_dim):
-            sort_indices = sort_indices_by_dim[dim]
-            X_dim_sorted = X[sort_indices, dim]
-            if not dense:
-                X_dim_sorted = self._to_array(X_dim_sorted)
-
-            split_indices = 1 + np.where(np.diff(X_dim_sorted) != 0)[0]  # we can only split between *different* data points
-            if len(split_indices) == 0:
-                # no split possible along this dimension
-                continue
-
-            y_sorted = y[sort_indices]
-
-            # compute data likelihoods of all possible splits along this dimension and find split with highest data likelihood
-            log_p_data_split = self._compute_log_p_data_split(y_sorted, split_indices, n_dim)
-            i_max = log_p_data_split.argmax()
-            if log_p_data_split[i_max] > best_log_p_data_split:
-                # remember new best split
-                best_log_p_data_split = log_p_data_split[i_max]
-                best_split_index = split_indices[i_max]  # data index of best split
-                best_split_dimension = dim
+        dim, split_index, log_p_data_split = self._find_best_split(X_search, y, sort_indices_by_dim, n_dim, in_node)
+        if log_p_data_split > best_log_p_data_split:
+            best_log_p_data_split = log_p_data_split
+            best_split_index = split_index
+            best_split_dimension = dim
 
         # did we find a split that has a higher likelihood than the no-split likelihood?
+        child_tasks = []
         if best_split_index > 0:
-            # split data and target to recursively train children
+            # split data and target to train children
             indices1 = sort_indices_by_dim[best_split_dimension, :best_split_index]
             indices2 = sort_indices_by_dim[best_split_dimension, best_split_index:]
 
-            # compute 'active' data indices for the children
-            active1 = np.zeros(X.shape[0], dtype=bool)
-            active2 = np.zeros(X.shape[0], dtype=bool)
-            active1[indices1] = True
-            active2[indices2] = True
+            n_data1 = len(indices1)
+            n_data2 = len(indices2)
+            y1 = y[indices1]
+            y2 = y[indices2]
 
-            # update sort indices for children based on the overall sort indices and the active data indices
-            sort_indices_by_dim_1 = np.array([si[active1[si]] for si in sort_indices_by_dim])
-            sort_indices_by_dim_2 = np.array([si[active2[si]] for si in sort_indices_by_dim])
+            # mark 'active' data indices for the LHS child (all others belong to the RHS child)
+            active1[indices1] = 1
 
-            n_data1 = sort_indices_by_dim_1.shape[1]
-            n_data2 = sort_indices_by_dim_2.shape[1]
+            # update sort indices for children based on the overall sort indices and the active data indices
+            sort_indices_by_dim_1, sort_indices_by_dim_2 = partition_sort_indices(sort_indices_by_dim, active1, n_data1)
+            active1[indices1] = 0
 
             # compute posteriors of children and priors for further splitting
-            prior_child1 = self._compute_posterior(y[indices1], delta) if delta != 0 else self.prior
-            prior_child2 = self._compute_posterior(y[indices2], delta) if delta != 0 else self.prior
+            prior_child1 = self._compute_posterior(y1, delta) if delta != 0 else self.prior
+            prior_child2 = self._compute_posterior(y2, delta) if delta != 0 else self.prior
 
             # store split info, create children and continue training them if there's data left to split
-            self.split_dimension = best_split_dimension
-            self.split_feature_name = feature_names[best_split_dimension]
+            self.split_dimension = int(dims[best_split_dimension])
+            self.split_feature_name = feature_names[self.split_dimension]
             self.split_value = 0.5 * (
                     X[indices1[-1], best_split_dimension]
                     + X[indices2[0], best_split_dimension]
@@ -170,32 +303,120 @@ class BasePerpendicularTree(BaseTree, ABC):
 
             # fit children if there is more than one data point (i.e., there is
             # something to split) and if the targets differ (no point otherwise)
-            y1 = y[indices1]
-            y2 = y[indices2]
-            if n_data1 > 1 and len(np.unique(y1)) > 1:
-                self.child1._fit(X, y, delta, verbose, feature_names, 'LHS', sort_indices_by_dim_1)
+            if n_data1 > 1 and has_different_values(y1):
+                child_tasks.append(NodeTask(self.child1, 'LHS', sort_indices_by_dim_1))
             else:
                 self.child1.posterior = self._compute_posterior(y1)
                 self.child1.n_data = n_data1
 
-            if n_data2 > 1 and len(np.unique(y2)) > 1:
-                self.child2._fit(X, y, delta, verbose, feature_names, 'RHS', sort_indices_by_dim_2)
+            if n_data2 > 1 and has_different_values(y2):
+                child_tasks.append(NodeTask(self.child2, 'RHS', sort_indices_by_dim_2))
             else:
                 self.child2.posterior = self._compute_posterior(y2)
                 self.child2.n_data = n_data2
 
-        # compute posterior
+        # compute posterior (of split nodes only if the children's priors differ, see _fit() otherwise)
         self.n_dim = n_dim
         self.n_data = n_data
-        self.posterior = self._compute_posterior(y[sort_indices_by_dim[0]])  # any dim works as the order doesn't matter
+        if best_split_index <= 0 or delta != 0:
+            self.posterior = self._compute_posterior(y_node)
+
+        return child_tasks
+
+    def _predict(self, X, predict_class):
+        if isinstance(X, np.ndarray):
+            # models pickled with version 0.2 or earlier don't have a flattened tree
+            if getattr(self, '_flat_tree', None) is not None:
+                return self._predict_flat_tree(X, predict_class)
+
+            return BaseTree._predict(self, X, predict_class)
+
+        # sparse data: densify each column used for splitting only once rather than at every node using it
+        X = csc_matrix(X)
+        dense_columns = {dim: self._to_array(X[:, dim]) for dim in self._get_split_dimensions()}
+
+        return self._predict_dense_columns(dense_columns, np.arange(X.shape[0]), predict_class)
+
+    def _predict_flat_tree(self, X, predict_class):
+        flat_tree = self._flat_tree
+        leaves = predict_leaves(X, flat_tree.split_dimension, flat_tree.split_value, flat_tree.child1, flat_tree.child2)
+        return flat_tree.prediction[leaves] if predict_class else flat_tree.posterior_mean[leaves]
+
+    def _compile(self):
+        # number the nodes breadth-first and store their split info in parallel arrays
+        nodes = [self]
+        split_dimension = []
+        split_value = []
+        child1 = []
+        child2 = []
+        path = [()]
+        for i, node in enumerate(nodes):
+            if node.is_leaf():
+                split_dimension.append(-1)
+                split_value.append(0.0)
+                child1.append(-1)
+                child2.append(-1)
+            else:
+                split_dimension.append(node.split_dimension)
+                split_value.append(node.split_value)
+                child1.append(len(nodes))
+                child2.append(len(nodes)+1)
+                nodes += [node.child1, node.child2]
+                step1 = (node.split_dimension, node.split_feature_name, node.split_value, False)
+                step2 = (node.split_dimension, node.split_feature_name, node.split_value, True)
+                path += [path[i] + (step1,), path[i] + (step2,)]
+                path[i] = None
+
+        prediction = np.array([node._predict_leaf() if node.is_leaf() else np.nan for node in nodes], dtype=np.float64)
+        posterior_mean = None
+        if not self.is_regression:
+            posterior_mean = np.zeros((len(nodes), len(self.prior)))
+            for i, node in enumerate(nodes):
+                if node.is_leaf():
+                    posterior_mean[i] = node._compute_posterior_mean()
+
+        self._flat_tree = FlatTree(
+            np.array(split_dimension, dtype=np.int64),
+            np.array(split_value, dtype=np.float64),
+            np.array(child1, dtype=np.int64),
+            np.array(child2, dtype=np.int64),
+            prediction,
+            posterior_mean,
+            path)
+
+    def _predict_dense_columns(self, dense_columns, rows, predict_class):
+        if self.is_leaf():
+            return self._create_leaf_predictions_array(rows, predict_class)
+
+        indices1, indices2 = self._split_indices(dense_columns[self.split_dimension][rows])
+
+        # let both children predict their side and then re-assemble
+        predictions_merged = None
+        for child, indices in ((self.child1, indices1), (self.child2, indices2)):
+            if len(indices) > 0:
+                predictions = child._predict_dense_columns(dense_columns, rows[indices], predict_class)
+                if predictions_merged is None:
+                    predictions_merged = self._create_merged_predictions_array(rows, predict_class, predictions)
+
+                predictions_merged[indices] = predictions
+
+        return predictions_merged
+
+    def _get_split_dimensions(self):
+        return {node.split_dimension for node in self._get_nodes() if not node.is_leaf()}
 
     def _compute_child1_and_child2_indices(self, X, dense):
         X_split = X[:, self.split_dimension]
         if not dense:
             X_split = self._to_array(X_split)
 
-        indices1 = np.where(X_split < self.split_value)[0]
-        indices2 = np.where(X_split >= self.split_value)[0]
+        return self._split_indices(X_split)
+
+    def _split_indices(self, X_split):
+        # single comparison pass, the RHS is its complement
+        is_child1 = X_split < self.split_value
+        indices1 = np.flatnonzero(is_child1)
+        indices2 = np.flatnonzero(~is_child1)
 
         return indices1, indices2
 
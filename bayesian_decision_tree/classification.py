@@ -11,6 +11,8 @@ from sklearn.base import ClassifierMixin
 from bayesian_decision_tree.base import BaseTree
 from bayesian_decision_tree.base_hyperplane import BaseHyperplaneTree
 from bayesian_decision_tree.base_perpendicular import BasePerpendicularTree
+from bayesian_decision_tree.kernels import best_split_dense, best_split_sparse, log_p_data_split_classification, \
+    log_p_data_split_sorted_classification, sufficient_statistics_classification
 from bayesian_decision_tree.utils import multivariate_betaln
 
 
@@ -23,7 +25,7 @@ class BaseClassificationTree(BaseTree, ABC, ClassifierMixin):
     def __init__(self, partition_prior, prior, child_type, level=0):
         super().__init__(partition_prior, prior, child_type, False, level)
 
-    def predict_proba(self, X):
+    def predict_proba(self, X, n_jobs=1):
         """Predict class probabilities of the input samples X.
 
         Parameters
@@ -31,6 +33,10 @@ class BaseClassificationTree(BaseTree, ABC, ClassifierMixin):
         X : array-like, scipy.sparse.csc_matrix, scipy.sparse.csr_matrix, pandas.DataFrame or pandas.SparseDataFrame, shape = [n_samples, n_features]
             The input samples.
 
+        n_jobs : int or None, default=1
+            The number of threads to predict with, -1 means using all processors, None means 1. Only
+            batches of at least 4096 samples are split up.
+
         Returns
         -------
         p : array of shape = [n_samples, n_classes]
@@ -41,7 +47,7 @@ class BaseClassificationTree(BaseTree, ABC, ClassifierMixin):
         X, _ = self._normalize_data_and_feature_names(X)
         self._ensure_is_fitted(X)
 
-        return self._predict(X, predict_class=False)
+        return self._predict_in_chunks(X, False, n_jobs)
 
     def _check_target(self, y):
         if y.ndim != 1:
@@ -61,24 +67,26 @@ class BaseClassificationTree(BaseTree, ABC, ClassifierMixin):
         return log_p_prior + log_p_data
 
     def _compute_log_p_data_split(self, y, split_indices, n_dim):
-        alphas = self.prior
-        n_classes = len(alphas)
-        k1 = np.array(n_classes * [None])
-        k2 = np.array(n_classes * [None])
-        for i in range(n_classes):
-            k1_and_total = (y == i).cumsum()
-            total = k1_and_total[-1]
-            k1[i] = k1_and_total[split_indices-1]
-            k2[i] = total - k1[i]
-
         n_splits = len(split_indices)
         log_p_prior = np.log(self.partition_prior**(1+self.level) / (n_splits * n_dim))
 
-        betaln_prior = multivariate_betaln(alphas)
-        log_p_data1 = self._compute_log_p_data(k1, betaln_prior)
-        log_p_data2 = self._compute_log_p_data(k2, betaln_prior)
+        # the ahead-of-time compiled kernel, if built, expects exactly float64
+        prior = np.asarray(self.prior, dtype=np.float64)
+
+        return log_p_data_split_classification(y, split_indices, prior, log_p_prior)
+
+    def _find_best_split(self, X, y, sort_indices_by_dim, n_dim, in_node):
+        partition_prior_pow = self.partition_prior**(1+self.level)
 
-        return log_p_prior + log_p_data1 + log_p_data2
+        # the callbacks of the split search expect exactly float64
+        prior = np.ascontiguousarray(self.prior, dtype=np.float64)
+        if isinstance(X, np.ndarray):
+            return best_split_dense(X, y, sort_indices_by_dim, prior, partition_prior_pow, n_dim,
+                                    sufficient_statistics_classification, log_p_data_split_sorted_classification)
+
+        # CSC sparse matrix
+        return best_split_sparse(X.indptr, X.indices, X.data, y, sort_indices_by_dim, in_node, prior, partition_prior_pow,
+                                 n_dim, sufficient_statistics_classification, log_p_data_split_sorted_classification)
 
     def _compute_posterior(self, y, delta=1):
         alphas = self.prior
@@ -93,17 +101,14 @@ class BaseClassificationTree(BaseTree, ABC, ClassifierMixin):
 
         return alphas_post
 
+    def _combine_posteriors(self, posterior1, posterior2, n_data1, n_data2):
+        # class counts are additive
+        return posterior1 + posterior2 - self.prior
+
     def _compute_posterior_mean(self):
         alphas = self.posterior
         return alphas / np.sum(alphas)
 
-    def _compute_log_p_data(self, k, betaln_prior):
-        alphas = self.prior
-
-        # see https://www.cs.ubc.ca/~murphyk/Teaching/CS340-Fall06/reading/bernoulli.pdf, equation (42)
-        # which can be expressed as a fraction of beta functions
-        return multivariate_betaln(alphas+k) - betaln_prior
-
     def _predict_leaf(self):
         # predict class
         return np.argmax(self.posterior)
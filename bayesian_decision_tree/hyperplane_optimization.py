@@ -4,6 +4,8 @@ import numpy as np
 from numpy.random import RandomState
 from scipy.sparse import csr_matrix, csc_matrix
 
+from bayesian_decision_tree.kernels import find_split_indices
+
 
 class HyperplaneOptimizationFunction:
     """
@@ -20,6 +22,9 @@ class HyperplaneOptimizationFunction:
         self.log_p_data_no_split = log_p_data_no_split
         self.search_space_is_unit_hypercube = search_space_is_unit_hypercube
 
+        # scratch space for the split indices, reused across all function evaluations
+        self.split_indices_buffer = np.empty(max(X.shape[0]-1, 0), dtype=np.int64)
+
         # results of the optimization - to be set later during the actual optimization
         self.function_evaluations = 0
         self.best_log_p_data_split = log_p_data_no_split
@@ -82,8 +87,9 @@ class HyperplaneOptimizationFunction:
         # compute distance of all points to the hyperplane: https://mathinsight.org/distance_point_plane
         projections = self.X @ hyperplane_normal  # up to an additive constant which doesn't matter to distance ordering
         sort_indices = np.argsort(projections)
-        split_indices = 1 + np.where(np.diff(projections) != 0)[0]  # we can only split between *different* data points
-        if len(split_indices) == 0:
+        n_splits = find_split_indices(projections[sort_indices], self.split_indices_buffer)
+        split_indices = self.split_indices_buffer[:n_splits]
+        if n_splits == 0:
             # no split possible along this dimension
             return -self.log_p_data_no_split
 
@@ -0,0 +1,514 @@
+"""
+This module declares the Numba-compiled kernels used by the Bayesian tree models:
+* find_split_indices: indices at which the values of a sorted array change (i.e., the possible splits)
+* log_p_data_split_regression: data log-likelihoods of candidate splits (Normal-gamma model)
+* log_p_data_split_classification: data log-likelihoods of candidate splits (Dirichlet model)
+* best_split_dense: best perpendicular split across all feature dimensions of a dense data matrix for any leaf model
+* best_split_sparse: same as best_split_dense but for CSC sparse data matrices
+* sufficient_statistics_regression, log_p_data_split_sorted_regression: leaf model callbacks of the split search
+  (Normal-gamma model)
+* sufficient_statistics_classification, log_p_data_split_sorted_classification: leaf model callbacks of the split
+  search (Dirichlet model)
+* partition_sort_indices: sort indices of both children of a split
+* has_different_values: whether an array contains at least two different values
+* predict_leaves: leaf node indices of a flattened perpendicular tree for all rows of a data matrix
+"""
+import math
+
+import numpy as np
+from numba import cfunc, njit, prange, types
+
+LOG_2_PI = math.log(2*math.pi)
+
+
+@njit(nogil=True, cache=True)
+def find_split_indices(x_sorted, split_indices):
+    # we can only split between *different* data points, so store all indices
+    # where the sorted values change and return the number of such indices
+    n_splits = 0
+    for i in range(1, len(x_sorted)):
+        if x_sorted[i] != x_sorted[i-1]:
+            split_indices[n_splits] = i
+            n_splits += 1
+
+    return n_splits
+
+
+@njit(nogil=True, cache=True)
+def _log_p_data_regression(n, mean, y_minus_mean_sq_sum, mu, kappa, alpha, beta):
+    # see https://www.cs.ubc.ca/~murphyk/Papers/bayesGauss.pdf, equations (86) - (89) and (95)
+    kappa_post = kappa + n
+    alpha_post = alpha + 0.5*n
+    beta_post = beta + 0.5*y_minus_mean_sq_sum + 0.5*kappa*n*(mean-mu)**2 / (kappa+n)
+
+    return (math.lgamma(alpha_post) - math.lgamma(alpha)
+            + alpha*math.log(beta) - alpha_post*math.log(beta_post)
+            + 0.5*math.log(kappa/kappa_post)
+            - 0.5*n*LOG_2_PI)
+
+
+@njit(nogil=True, cache=True)
+def _log_p_data_split_regression(n1, sum1, sum_sq1, n, total, total_sq, shift, prior, log_p_prior):
+    # all sums are over the shifted targets y-shift (which leaves the squared deviations from
+    # the mean unchanged but avoids cancellation), sum1/sum_sq1 are the sums of the LHS
+    mu, kappa, alpha, beta = prior[0], prior[1], prior[2], prior[3]
+    n2 = n - n1
+    sum2 = total - sum1
+    sum_sq2 = total_sq - sum_sq1
+
+    y_minus_mean_sq_sum1 = max(sum_sq1 - sum1*sum1/n1, 0.0)
+    y_minus_mean_sq_sum2 = max(sum_sq2 - sum2*sum2/n2, 0.0)
+    log_p_data1 = _log_p_data_regression(n1, shift + sum1/n1, y_minus_mean_sq_sum1, mu, kappa, alpha, beta)
+    log_p_data2 = _log_p_data_regression(n2, shift + sum2/n2, y_minus_mean_sq_sum2, mu, kappa, alpha, beta)
+
+    return log_p_prior + log_p_data1 + log_p_data2
+
+
+@njit(nogil=True, cache=True)
+def _shifted_sums(y, shift):
+    total = 0.0
+    total_sq = 0.0
+    for i in range(len(y)):
+        d = y[i] - shift
+        total += d
+        total_sq += d*d
+
+    return total, total_sq
+
+
+@njit(nogil=True, cache=True)
+def _sufficient_statistics_regression(y, statistics):
+    # the shift (the mean) and the sums of the shifted targets and of their squares
+    shift = y.mean()
+    total, total_sq = _shifted_sums(y, shift)
+    statistics[0] = shift
+    statistics[1] = total
+    statistics[2] = total_sq
+
+
+@njit(nogil=True, cache=True)
+def _log_p_data_split_sorted_regression(y_sorted, n_negative, n_zero, split_indices, statistics, prior, log_p_prior,
+                                        log_p_data_split):
+    # see the leaf model callbacks below for the arguments
+    shift = statistics[0]
+    total = statistics[1]
+    total_sq = statistics[2]
+    n = len(y_sorted) + n_zero
+
+    # the sufficient statistics of the zeros follow from the totals, so we never visit them
+    zero_sum = 0.0
+    zero_sum_sq = 0.0
+    if n_zero > 0:
+        non_zero_sum, non_zero_sum_sq = _shifted_sums(y_sorted, shift)
+        zero_sum = total - non_zero_sum
+        zero_sum_sq = total_sq - non_zero_sum_sq
+
+    # cumulative sufficient statistics (n, sum(y), sum(y^2)) of the LHS, evaluated at every split
+    sum1 = 0.0
+    sum_sq1 = 0.0
+    i_prev = 0
+    for j in range(len(split_indices)):
+        i = split_indices[j]
+        i_non_zero = i if i <= n_negative else i - n_zero
+        for k in range(i_prev, i_non_zero):
+            d = y_sorted[k] - shift
+            sum1 += d
+            sum_sq1 += d*d
+
+        i_prev = i_non_zero
+        if i > n_negative:
+            log_p_data_split[j] = _log_p_data_split_regression(
+                i, sum1 + zero_sum, sum_sq1 + zero_sum_sq, n, total, total_sq, shift, prior, log_p_prior)
+        else:
+            log_p_data_split[j] = _log_p_data_split_regression(
+                i, sum1, sum_sq1, n, total, total_sq, shift, prior, log_p_prior)
+
+
+@njit(nogil=True, cache=True)
+def log_p_data_split_regression(y, split_indices, prior, log_p_prior):
+    statistics = np.empty(3)
+    _sufficient_statistics_regression(y, statistics)
+    log_p_data_split = np.empty(len(split_indices))
+    _log_p_data_split_sorted_regression(y, len(y), 0, split_indices, statistics, prior, log_p_prior, log_p_data_split)
+
+    return log_p_data_split
+
+
+@njit(nogil=True, cache=True)
+def _multivariate_betaln(alphas, k):
+    # see https://en.wikipedia.org/wiki/Beta_function#Multivariate_beta_function
+    log_beta = 0.0
+    alpha_sum = 0.0
+    for i in range(len(alphas)):
+        log_beta += math.lgamma(alphas[i] + k[i])
+        alpha_sum += alphas[i] + k[i]
+
+    return log_beta - math.lgamma(alpha_sum)
+
+
+@njit(nogil=True, cache=True)
+def _log_p_data_split_classification(k1, total, k2, alphas, betaln_prior, log_p_prior):
+    # see https://www.cs.ubc.ca/~murphyk/Teaching/CS340-Fall06/reading/bernoulli.pdf, equation (42)
+    # which can be expressed as a fraction of beta functions; k2 is a scratch buffer for the RHS counts
+    for c in range(len(alphas)):
+        k2[c] = total[c] - k1[c]
+
+    log_p_data1 = _multivariate_betaln(alphas, k1) - betaln_prior
+    log_p_data2 = _multivariate_betaln(alphas, k2) - betaln_prior
+
+    return log_p_prior + log_p_data1 + log_p_data2
+
+
+@njit(nogil=True, cache=True)
+def _class_counts(y, n_classes):
+    counts = np.zeros(n_classes)
+    for i in range(len(y)):
+        counts[int(y[i])] += 1
+
+    return counts
+
+
+@njit(nogil=True, cache=True)
+def _log_p_data_split_sorted_classification(y_sorted, n_negative, n_zero, split_indices, total, alphas, log_p_prior,
+                                            log_p_data_split):
+    # see the leaf model callbacks below for the arguments, the sufficient statistics are the class counts
+    n_classes = len(alphas)
+    betaln_prior = _multivariate_betaln(alphas, np.zeros(n_classes))
+
+    # the class counts of the zeros follow from the totals, so we never visit them
+    k_zero = np.zeros(n_classes)
+    if n_zero > 0:
+        k_zero = total - _class_counts(y_sorted, n_classes)
+
+    # cumulative class counts of the LHS, evaluated at every split
+    k1 = np.zeros(n_classes)
+    k1_with_zeros = np.empty(n_classes)
+    k2 = np.empty(n_classes)
+    i_prev = 0
+    for j in range(len(split_indices)):
+        i = split_indices[j]
+        i_non_zero = i if i <= n_negative else i - n_zero
+        for k in range(i_prev, i_non_zero):
+            k1[int(y_sorted[k])] += 1
+
+        i_prev = i_non_zero
+        if i > n_negative:
+            for c in range(n_classes):
+                k1_with_zeros[c] = k1[c] + k_zero[c]
+
+            log_p_data_split[j] = _log_p_data_split_classification(
+                k1_with_zeros, total, k2, alphas, betaln_prior, log_p_prior)
+        else:
+            log_p_data_split[j] = _log_p_data_split_classification(k1, total, k2, alphas, betaln_prior, log_p_prior)
+
+
+@njit(nogil=True, cache=True)
+def log_p_data_split_classification(y, split_indices, alphas, log_p_prior):
+    total = _class_counts(y, len(alphas))
+    log_p_data_split = np.empty(len(split_indices))
+    _log_p_data_split_sorted_classification(y, len(y), 0, split_indices, total, alphas, log_p_prior, log_p_data_split)
+
+    return log_p_data_split
+
+
+# The split search drivers below are shared by all leaf models, which plug in through two C callbacks (compiled
+# once and cached, unlike jitted functions passed as arguments which would make the drivers recompile in every
+# process), both of which take the prior as an argument:
+# - sufficient_statistics(y, prior, statistics): stores the sufficient statistics of the targets y of a node in
+#   'statistics', an array of the size of the prior
+# - log_p_data_split(y_sorted, n_negative, n_zero, split_indices, statistics, prior, log_p_prior, log_p_data_split):
+#   stores the data log-likelihoods of the splits 'split_indices' in 'log_p_data_split', where y_sorted are the
+#   node's targets sorted by feature value, except for those of the n_zero data points whose value is 0 (sparse
+#   data only) which belong between the first n_negative ones and the rest and which follow from 'statistics'
+SUFFICIENT_STATISTICS_SIGNATURE = types.void(types.float64[::1], types.float64[::1], types.float64[::1])
+LOG_P_DATA_SPLIT_SIGNATURE = types.void(
+    types.float64[::1], types.int64, types.int64, types.int64[::1], types.float64[::1], types.float64[::1],
+    types.float64, types.float64[::1])
+
+
+@cfunc(SUFFICIENT_STATISTICS_SIGNATURE, cache=True)
+def sufficient_statistics_regression(y, prior, statistics):
+    _sufficient_statistics_regression(y, statistics)
+
+
+@cfunc(LOG_P_DATA_SPLIT_SIGNATURE, cache=True)
+def log_p_data_split_sorted_regression(y_sorted, n_negative, n_zero, split_indices, statistics, prior, log_p_prior,
+                                       log_p_data_split):
+    _log_p_data_split_sorted_regression(
+        y_sorted, n_negative, n_zero, split_indices, statistics, prior, log_p_prior, log_p_data_split)
+
+
+@cfunc(SUFFICIENT_STATISTICS_SIGNATURE, cache=True)
+def sufficient_statistics_classification(y, alphas, statistics):
+    statistics[:] = _class_counts(y, len(alphas))
+
+
+@cfunc(LOG_P_DATA_SPLIT_SIGNATURE, cache=True)
+def log_p_data_split_sorted_classification(y_sorted, n_negative, n_zero, split_indices, statistics, alphas, log_p_prior,
+                                           log_p_data_split):
+    _log_p_data_split_sorted_classification(
+        y_sorted, n_negative, n_zero, split_indices, statistics, alphas, log_p_prior, log_p_data_split)
+
+
+@njit(nogil=True, cache=True)
+def _sort_dimension(X, y, sort_indices, dim, x_sorted, y_sorted, split_indices):
+    for i in range(len(sort_indices)):
+        x_sorted[i] = X[sort_indices[i], dim]
+        y_sorted[i] = y[sort_indices[i]]
+
+    return _find_split_indices(x_sorted, split_indices)
+
+
+@njit(nogil=True, cache=True)
+def _sort_sparse_dimension(indptr, indices, data, y, in_node, dim):
+    # collect the non-zero values of this dimension that belong to the node along with
+    # their targets, see https://arxiv.org/abs/1901.03214 for the sparse split search
+    start = indptr[dim]
+    end = indptr[dim+1]
+    values = np.empty(end - start)
+    y_non_zero = np.empty(end - start)
+    n_non_zero = 0
+    for k in range(start, end):
+        if in_node[indices[k]] and data[k] != 0:
+            values[n_non_zero] = data[k]
+            y_non_zero[n_non_zero] = y[indices[k]]
+            n_non_zero += 1
+
+    order = np.argsort(values[:n_non_zero], kind='mergesort')
+    return values[:n_non_zero][order], y_non_zero[:n_non_zero][order]
+
+
+@njit(nogil=True, cache=True)
+def _find_sparse_split_indices(values, n_negative, n_zero, split_indices):
+    # the sorted data consists of the negative values followed by the zeros and then the positive values,
+    # so we can split between distinct negative values, at both ends of the zeros and between distinct
+    # positive values
+    n_non_zero = len(values)
+    n_data = n_non_zero + n_zero
+    n_splits = 0
+    for i in range(1, n_negative):
+        if values[i] != values[i-1]:
+            split_indices[n_splits] = i
+            n_splits += 1
+
+    if 0 < n_negative < n_data:
+        split_indices[n_splits] = n_negative
+        n_splits += 1
+
+    if n_zero > 0 and n_negative + n_zero < n_data:
+        split_indices[n_splits] = n_negative + n_zero
+        n_splits += 1
+
+    for i in range(n_negative+1, n_non_zero):
+        if values[i] != values[i-1]:
+            split_indices[n_splits] = i + n_zero
+            n_splits += 1
+
+    return n_splits
+
+
+@njit(nogil=True, cache=True)
+def _set_in_node(in_node, sort_indices, value):
+    for i in range(len(sort_indices)):
+        in_node[sort_indices[i]] = value
+
+
+@njit(nogil=True, cache=True)
+def _node_statistics(y, sort_indices, prior, sufficient_statistics):
+    # the sufficient statistics of the node's targets (in any order), see above
+    statistics = np.empty(len(prior))
+    sufficient_statistics(y[sort_indices], prior, statistics)
+
+    return statistics
+
+
+@njit(nogil=True, cache=True)
+def _store_best_split(best_by_dim, dim, split_indices, log_p_data_split):
+    # columns: dimension, split index, log-likelihood
+    i_max = log_p_data_split.argmax()
+    best_by_dim[dim, 0] = dim
+    best_by_dim[dim, 1] = split_indices[i_max]
+    best_by_dim[dim, 2] = log_p_data_split[i_max]
+
+
+@njit(nogil=True, cache=True)
+def _reduce_best_split(best_by_dim):
+    # pick the dimension with the highest log-likelihood (the first one in case of ties)
+    best_dim = -1
+    best_split_index = -1
+    best_log_p_data_split = -np.inf
+    for dim in range(best_by_dim.shape[0]):
+        if best_by_dim[dim, 2] > best_log_p_data_split:
+            best_dim = dim
+            best_split_index = int(best_by_dim[dim, 1])
+            best_log_p_data_split = best_by_dim[dim, 2]
+
+    return best_dim, best_split_index, best_log_p_data_split
+
+
+@njit(parallel=True, nogil=True, cache=True)
+def best_split_dense(X, y, sort_indices_by_dim, prior, partition_prior_pow, n_dim, sufficient_statistics,
+                     log_p_data_split):
+    # n_dim is the number of all feature dimensions (for the partition prior), including those that have been
+    # left out of sort_indices_by_dim because they can't be split
+    n_dim_split = sort_indices_by_dim.shape[0]
+    n_data = sort_indices_by_dim.shape[1]
+    statistics = _node_statistics(y, sort_indices_by_dim[0], prior, sufficient_statistics)
+
+    best_by_dim = np.full((n_dim_split, 3), -np.inf)
+    for dim in prange(n_dim_split):
+        x_sorted = np.empty(n_data)
+        y_sorted = np.empty(n_data)
+        split_indices = np.empty(max(n_data-1, 0), dtype=np.int64)
+        n_splits = _sort_dimension(X, y, sort_indices_by_dim[dim], dim, x_sorted, y_sorted, split_indices)
+        if n_splits == 0:
+            # no split possible along this dimension
+            continue
+
+        log_p_prior = np.log(partition_prior_pow / (n_splits * n_dim))
+        log_p_data_split_dim = np.empty(n_splits)
+        log_p_data_split(
+            y_sorted, n_data, 0, split_indices[:n_splits], statistics, prior, log_p_prior, log_p_data_split_dim)
+        _store_best_split(best_by_dim, dim, split_indices, log_p_data_split_dim)
+
+    return _reduce_best_split(best_by_dim)
+
+
+@njit(parallel=True, nogil=True, cache=True)
+def best_split_sparse(indptr, indices, data, y, sort_indices_by_dim, in_node, prior, partition_prior_pow, n_dim,
+                      sufficient_statistics, log_p_data_split):
+    # same as best_split_dense() but only visits the non-zero values of the CSC sparse data matrix,
+    # see https://arxiv.org/abs/1901.03214 for the sparse split search
+    n_dim_split = sort_indices_by_dim.shape[0]
+    n_data = sort_indices_by_dim.shape[1]
+    statistics = _node_statistics(y, sort_indices_by_dim[0], prior, sufficient_statistics)
+
+    # in_node is a scratch array (all zeros) of the size of the entire data set which no concurrent call may use,
+    # mark the node's data points and clear them again at the end rather than allocating it for every node
+    _set_in_node(in_node, sort_indices_by_dim[0], 1)
+
+    best_by_dim = np.full((n_dim_split, 3), -np.inf)
+    for dim in prange(n_dim_split):
+        values, y_non_zero = _sort_sparse_dimension(indptr, indices, data, y, in_node, dim)
+        n_non_zero = len(values)
+        n_negative = np.searchsorted(values, 0.0)
+        n_zero = n_data - n_non_zero
+        split_indices = np.empty(n_non_zero+1, dtype=np.int64)
+        n_splits = _find_sparse_split_indices(values, n_negative, n_zero, split_indices)
+        if n_splits == 0:
+            # no split possible along this dimension
+            continue
+
+        log_p_prior = np.log(partition_prior_pow / (n_splits * n_dim))
+        log_p_data_split_dim = np.empty(n_splits)
+        log_p_data_split(y_non_zero, n_negative, n_zero, split_indices[:n_splits], statistics, prior, log_p_prior,
+                         log_p_data_split_dim)
+        _store_best_split(best_by_dim, dim, split_indices, log_p_data_split_dim)
+
+    _set_in_node(in_node, sort_indices_by_dim[0], 0)
+
+    return _reduce_best_split(best_by_dim)
+
+
+@njit(parallel=True, nogil=True, cache=True)
+def partition_sort_indices(sort_indices_by_dim, active1, n_data1):
+    n_dim, n_data = sort_indices_by_dim.shape
+    sort_indices_by_dim_1 = np.empty((n_dim, n_data1), dtype=sort_indices_by_dim.dtype)
+    sort_indices_by_dim_2 = np.empty((n_dim, n_data-n_data1), dtype=sort_indices_by_dim.dtype)
+
+    # stable partition of every dimension's sort indices in a single pass, which
+    # keeps the children's data sorted along all dimensions
+    for dim in prange(n_dim):
+        sort_indices = sort_indices_by_dim[dim]
+        i1 = 0
+        i2 = 0
+        for i in range(n_data):
+            index = sort_indices[i]
+            if active1[index]:
+                sort_indices_by_dim_1[dim, i1] = index
+                i1 += 1
+            else:
+                sort_indices_by_dim_2[dim, i2] = index
+                i2 += 1
+
+    return sort_indices_by_dim_1, sort_indices_by_dim_2
+
+
+@njit(nogil=True, cache=True)
+def has_different_values(y):
+    # single pass with early exit (unlike len(np.unique(y)) > 1 which sorts)
+    for i in range(1, len(y)):
+        if y[i] != y[0]:
+            return True
+
+    return False
+
+
+@njit(nogil=True, cache=True)
+def predict_leaves(X, split_dimension, split_value, child1, child2):
+    leaves = np.empty(X.shape[0], dtype=np.int64)
+    for row in range(X.shape[0]):
+        node = 0
+        while child1[node] != -1:
+            if X[row, split_dimension[node]] < split_value[node]:
+                node = child1[node]
+            else:
+                node = child2[node]
+
+        leaves[row] = node
+
+    return leaves
+
+
+# the jitted versions of the kernels which are replaced by their ahead-of-time compiled versions for Python callers
+# below, jitted kernels call them through these aliases because Numba resolves global functions at compile time
+_find_split_indices = find_split_indices
+_log_p_data_split_regression_all = log_p_data_split_regression
+_log_p_data_split_classification_all = log_p_data_split_classification
+_has_different_values = has_different_values
+
+try:
+    # built by _aot.py, avoids JIT compilation on first use
+    from bayesian_decision_tree import _aot_kernels
+except ImportError:
+    _aot_kernels = None
+
+
+def _as_float64(array):
+    return np.ascontiguousarray(array, dtype=np.float64)
+
+
+def _as_int64(array):
+    return np.ascontiguousarray(array, dtype=np.int64)
+
+
+# the ahead-of-time compiled kernels only accept the exact argument types they have been compiled for
+# and reinterpret the memory of arrays of any other type, so these shims convert the arguments first
+
+def _aot_find_split_indices(x_sorted, split_indices):
+    if split_indices.dtype != np.int64 or not split_indices.flags.c_contiguous:
+        # the split indices are written to this buffer, so it can't be a converted copy
+        return _find_split_indices(x_sorted, split_indices)
+
+    return _aot_kernels.find_split_indices(_as_float64(x_sorted), split_indices)
+
+
+def _aot_log_p_data_split_regression(y, split_indices, prior, log_p_prior):
+    return _aot_kernels.log_p_data_split_regression(
+        _as_float64(y), _as_int64(split_indices), _as_float64(prior), float(log_p_prior))
+
+
+def _aot_log_p_data_split_classification(y, split_indices, alphas, log_p_prior):
+    return _aot_kernels.log_p_data_split_classification(
+        _as_float64(y), _as_int64(split_indices), _as_float64(alphas), float(log_p_prior))
+
+
+def _aot_has_different_values(y):
+    return _aot_kernels.has_different_values(_as_float64(y))
+
+
+if _aot_kernels is not None:
+    find_split_indices = _aot_find_split_indices
+    log_p_data_split_regression = _aot_log_p_data_split_regression
+    log_p_data_split_classification = _aot_log_p_data_split_classification
+    has_different_values = _aot_has_different_values
@@ -12,6 +12,8 @@ from sklearn.base import RegressorMixin
 from bayesian_decision_tree.base import BaseTree
 from bayesian_decision_tree.base_hyperplane import BaseHyperplaneTree
 from bayesian_decision_tree.base_perpendicular import BasePerpendicularTree
+from bayesian_decision_tree.kernels import best_split_dense, best_split_sparse, log_p_data_split_regression, \
+    log_p_data_split_sorted_regression, sufficient_statistics_regression
 
 
 class BaseRegressionTree(BaseTree, ABC, RegressorMixin):
@@ -38,36 +40,26 @@ class BaseRegressionTree(BaseTree, ABC, RegressorMixin):
         return log_p_prior + log_p_data
 
     def _compute_log_p_data_split(self, y, split_indices, n_dim):
-        n = len(y)
-        n1 = np.arange(1, n)
-        n2 = n - n1
-        sum1 = y.cumsum()[:-1]
-        mean1 = sum1 / n1
-        mean2 = (y.sum() - sum1) / n2
-        y_minus_mean_sq_sum1 = ((y[:-1] - mean1)**2).cumsum()
-        y_minus_mean_sq_sum2 = ((y[1:] - mean2)[::-1]**2).cumsum()[::-1]
-
-        if len(split_indices) != len(y)-1:
-            # we are *not* splitting between all data points -> indexing necessary
-            split_indices_minus_1 = split_indices - 1
-
-            n1 = n1[split_indices_minus_1]
-            n2 = n2[split_indices_minus_1]
-            mean1 = mean1[split_indices_minus_1]
-            mean2 = mean2[split_indices_minus_1]
-            y_minus_mean_sq_sum1 = y_minus_mean_sq_sum1[split_indices_minus_1]
-            y_minus_mean_sq_sum2 = y_minus_mean_sq_sum2[split_indices_minus_1]
-
-        mu1, kappa1, alpha1, beta1 = self._compute_posterior_internal(n1, mean1, y_minus_mean_sq_sum1)
-        mu2, kappa2, alpha2, beta2 = self._compute_posterior_internal(n2, mean2, y_minus_mean_sq_sum2)
-
         n_splits = len(split_indices)
         log_p_prior = np.log(self.partition_prior**(1+self.level) / (n_splits * n_dim))
 
-        log_p_data1 = self._compute_log_p_data(alpha1, beta1, kappa1, n1)
-        log_p_data2 = self._compute_log_p_data(alpha2, beta2, kappa2, n2)
+        # the ahead-of-time compiled kernel, if built, expects exactly float64
+        prior = np.asarray(self.prior, dtype=np.float64)
+
+        return log_p_data_split_regression(y, split_indices, prior, log_p_prior)
 
-        return log_p_prior + log_p_data1 + log_p_data2
+    def _find_best_split(self, X, y, sort_indices_by_dim, n_dim, in_node):
+        partition_prior_pow = self.partition_prior**(1+self.level)
+
+        # the callbacks of the split search expect exactly float64
+        prior = np.ascontiguousarray(self.prior, dtype=np.float64)
+        if isinstance(X, np.ndarray):
+            return best_split_dense(X, y, sort_indices_by_dim, prior, partition_prior_pow, n_dim,
+                                    sufficient_statistics_regression, log_p_data_split_sorted_regression)
+
+        # CSC sparse matrix
+        return best_split_sparse(X.indptr, X.indices, X.data, y, sort_indices_by_dim, in_node, prior, partition_prior_pow,
+                                 n_dim, sufficient_statistics_regression, log_p_data_split_sorted_regression)
 
     def _compute_posterior(self, y, delta=1):
         if delta == 0:
@@ -91,6 +83,26 @@ class BaseRegressionTree(BaseTree, ABC, RegressorMixin):
 
         return mu_post, kappa_post, alpha_post, beta_post
 
+    def _combine_posteriors(self, posterior1, posterior2, n_data1, n_data2):
+        # posterior of the union of two disjoint data sets, both of which have been combined with this
+        # node's prior: recover their sufficient statistics by inverting equations (86) - (89), then merge them
+        mu, kappa, alpha, beta = self.prior
+
+        def sufficient_statistics(posterior, n):
+            mu_post, kappa_post, alpha_post, beta_post = posterior
+            mean = (kappa_post*mu_post - kappa*mu) / n
+            y_minus_mean_sq_sum = 2*(beta_post - beta) - kappa*n*(mean-mu)**2 / (kappa+n)
+            return mean, y_minus_mean_sq_sum
+
+        mean1, y_minus_mean_sq_sum1 = sufficient_statistics(posterior1, n_data1)
+        mean2, y_minus_mean_sq_sum2 = sufficient_statistics(posterior2, n_data2)
+
+        n = n_data1 + n_data2
+        mean = (n_data1*mean1 + n_data2*mean2) / n
+        y_minus_mean_sq_sum = y_minus_mean_sq_sum1 + y_minus_mean_sq_sum2 + n_data1*n_data2/n * (mean1-mean2)**2
+
+        return self._compute_posterior_internal(n, mean, y_minus_mean_sq_sum)
+
     def _compute_posterior_mean(self):
         return self.posterior[0]  # mu is the posterior mean
 
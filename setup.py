@@ -15,6 +15,7 @@
 # limitations under the License.
 
 from setuptools import setup, find_packages
+from setuptools.command import build_ext
 from os import path
 import versioneer
 
@@ -27,11 +28,38 @@ requirements = [
     'matplotlib>=2.2.*',
     'scipy>=1.2.*',
     'numpy>=1.13.*',
+    'numba>=0.45.*',
     'pandas>=0.23.*',
     'requests==2.21.0',
     'scikit-learn>=0.19.*',
 ]
 
+try:
+    # optional ahead-of-time compiled kernels, the jitted ones are used if these can't be built (numba.pycc
+    # not available, which is pending deprecation, or no C compiler found)
+    from bayesian_decision_tree._aot import cc
+    aot_extension = cc.distutils_extension()
+    aot_extension.optional = True
+    ext_modules = [aot_extension]
+except (ImportError, RuntimeError):
+    ext_modules = []
+
+
+# looked up only now because cc.distutils_extension() replaces build_ext.build_ext by a subclass compiling the
+# ahead-of-time kernels, which must be the base class here
+class OptionalBuildExt(build_ext.build_ext):
+    # skips optional extensions that fail to build, including errors raised while compiling the
+    # ahead-of-time kernels, which setuptools doesn't consider build errors
+    def build_extension(self, ext):
+        try:
+            super().build_extension(ext)
+        except Exception as e:
+            if not ext.optional:
+                raise
+
+            self.warn('skipping optional extension {}: {}'.format(ext.name, e))
+
+
 setup(
     name='bayesian-decision-tree',
     version=versioneer.get_version(),
@@ -51,4 +79,6 @@ setup(
     ],
     packages=find_packages(exclude=['contrib', 'docs', 'tests']),
     install_requires=requirements,
+    ext_modules=ext_modules,
+    cmdclass={'build_ext': OptionalBuildExt},
 )
@@ -1,3 +1,4 @@
+import numpy as np
 import pandas as pd
 from scipy.optimize._differentialevolution import DifferentialEvolutionSolver
 from scipy.sparse import csc_matrix, csr_matrix
@@ -38,3 +39,17 @@ def create_regression_trees(prior, partition_prior):
         HyperplaneRegressionTree(partition_prior, prior, optimizer=RandomHyperplaneOptimizer(100, 666)),
         HyperplaneRegressionTree(partition_prior, prior, optimizer=SimulatedAnnealingOptimizer(10, 10, 0.9, 666)),
     ]
+
+
+
+# wraps a kernel such that it fails unless the arguments at the given positions are float64 arrays (the
+# ahead-of-time compiled kernels, if built, don't convert their arguments but reinterpret their memory)
+def float64_only(kernel, *positions):
+    def checked_kernel(*args):
+        for position in positions:
+            if args[position].dtype != np.float64:
+                raise TypeError('Expected float64 but got {}'.format(args[position].dtype))
+
+        return kernel(*args)
+
+    return checked_kernel
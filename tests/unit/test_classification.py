@@ -1,12 +1,21 @@
-from unittest import TestCase
+from unittest import TestCase, skipUnless
+from unittest.mock import patch
 
 import numpy as np
 import pandas as pd
+from scipy.sparse import csc_matrix, csr_matrix
 from numpy.random import normal, randint
 from numpy.testing import assert_array_equal, assert_array_almost_equal
 
-from bayesian_decision_tree.classification import PerpendicularClassificationTree
-from tests.unit.helper import data_matrix_transforms, create_classification_trees
+from bayesian_decision_tree import kernels
+from bayesian_decision_tree.classification import PerpendicularClassificationTree, HyperplaneClassificationTree
+from bayesian_decision_tree.hyperplane_optimization import RandomTwoPointOptimizer
+from tests.unit.helper import data_matrix_transforms, create_classification_trees, float64_only
+
+try:
+    from bayesian_decision_tree import _aot_kernels
+except ImportError:
+    _aot_kernels = None
 
 
 class ClassificationTreeTest(TestCase):
@@ -359,3 +368,81 @@ class ClassificationTreeTest(TestCase):
             c2 = model1.child2.child2
             c12 = model2.child2
             assert_array_equal(c12.posterior, c1.posterior + c2.posterior - c12.prior)
+
+    def test_integer_targets_reach_kernels_as_float64(self):
+        np.random.seed(666)
+        X = normal(0, 1, [100, 2])
+        for dtype in [np.int32, np.int64]:
+            y = (X[:, 0] + X[:, 1] > 0).astype(dtype)
+            with patch('bayesian_decision_tree.base_perpendicular.has_different_values',
+                       float64_only(kernels.has_different_values, 0)), \
+                    patch('bayesian_decision_tree.base_hyperplane.has_different_values',
+                          float64_only(kernels.has_different_values, 0)), \
+                    patch('bayesian_decision_tree.classification.log_p_data_split_classification',
+                          float64_only(kernels.log_p_data_split_classification, 0, 2)):
+                for model in create_classification_trees(np.array([1, 1]), 0.5):
+                    print('Testing {}'.format(type(model).__name__))
+                    model.fit(X, y)
+
+    @skipUnless(_aot_kernels is not None, 'ahead-of-time compiled kernels not built')
+    def test_integer_targets_with_aot_kernels(self):
+        np.random.seed(666)
+        X = normal(0, 1, [100, 2])
+        y = (X[:, 0] + X[:, 1] > 0).astype(np.float64)
+        expected_models = create_classification_trees(np.array([1, 1]), 0.5)
+        for model in expected_models:
+            model.fit(X, y)
+
+        for dtype in [np.int32, np.int64]:
+            for model, expected_model in zip(create_classification_trees(np.array([1, 1]), 0.5), expected_models):
+                print('Testing {}'.format(type(model).__name__))
+                model.fit(X, y.astype(dtype))
+                self.assertEqual(model.get_n_leaves(), expected_model.get_n_leaves())
+                assert_array_equal(model.predict(X), expected_model.predict(X))
+
+    def test_float32_data_with_two_point_optimizer(self):
+        # the hyperplane normals are differences of data points and hence float32, as are the projections onto them
+        np.random.seed(666)
+        X = normal(0, 1, [100, 2]).astype(np.float32)
+        y = (X[:, 0] + X[:, 1] > 0).astype(np.float64)
+        for data_matrix_transform in [lambda X: X, csc_matrix, csr_matrix]:
+            X_transformed = data_matrix_transform(X)
+            model = HyperplaneClassificationTree(0.5, np.array([1, 1]), optimizer=RandomTwoPointOptimizer(100, 666))
+            model.fit(X_transformed, y)
+            print(model)
+
+            # same tree as the jitted kernels (which are the ones in use anyway unless the ahead-of-time
+            # compiled ones have been built)
+            model_jitted = HyperplaneClassificationTree(0.5, np.array([1, 1]), optimizer=RandomTwoPointOptimizer(100, 666))
+            with patch('bayesian_decision_tree.hyperplane_optimization.find_split_indices', kernels._find_split_indices), \
+                    patch('bayesian_decision_tree.base_hyperplane.has_different_values', kernels._has_different_values), \
+                    patch('bayesian_decision_tree.classification.log_p_data_split_classification',
+                          kernels._log_p_data_split_classification_all):
+                model_jitted.fit(X_transformed, y)
+
+            self.assertEqual(model.get_n_leaves(), model_jitted.get_n_leaves())
+            assert_array_equal(model.predict(X_transformed), model_jitted.predict(X_transformed))
+            self.assertTrue(np.mean(model.predict(X_transformed) == y) > 0.9)
+
+    def test_sparse_data_with_negative_values_and_zeros(self):
+        # negative values, zeros and positive values (the sparse split search handles those three blocks
+        # separately) along with explicitly stored zeros
+        np.random.seed(666)
+        X = np.round(normal(0, 1, [1000, 3]), 1)
+        X[np.random.uniform(size=X.shape) < 0.3] = 0
+        X_csc = csc_matrix(X)
+        X_csc.data[::7] = 0
+        X_csr = X_csc.tocsr()
+        X = X_csc.toarray()
+        self.assertTrue(np.any(X_csc.data == 0) and np.any(X_csr.data == 0))
+        y = (X[:, 0] < 0) + (X[:, 1] == 0) * (X[:, 2] > 0).astype(float)
+
+        model = PerpendicularClassificationTree(0.9, np.array([1, 1, 1]))
+        model.fit(X, y)
+        print(model)
+        for X_sparse in [X_csc, X_csr]:
+            model_sparse = PerpendicularClassificationTree(0.9, np.array([1, 1, 1]))
+            model_sparse.fit(X_sparse, y)
+            self.assertEqual(str(model_sparse), str(model))
+            assert_array_equal(model_sparse.predict(X_sparse), model.predict(X))
+            assert_array_equal(model_sparse.predict_proba(X_sparse), model.predict_proba(X))
@@ -1,11 +1,15 @@
+import pickle
 from unittest import TestCase
+from unittest.mock import patch
 
 import numpy as np
-from numpy.testing import assert_array_equal
+from numpy.testing import assert_allclose, assert_array_equal
+from scipy.sparse import csc_matrix
 from sklearn.metrics import mean_squared_error
 
+from bayesian_decision_tree import kernels
 from bayesian_decision_tree.regression import PerpendicularRegressionTree
-from tests.unit.helper import data_matrix_transforms, create_regression_trees
+from tests.unit.helper import data_matrix_transforms, create_regression_trees, float64_only
 
 
 class RegressionTreeTest(TestCase):
@@ -174,3 +178,334 @@ class RegressionTreeTest(TestCase):
                 self.assertTrue(mse_list[-1] < mse_list[0])
                 for i in range(0, len(mse_list)-1):
                     self.assertTrue(mse_list[i+1] <= mse_list[i])
+
+    def test_parallel_prediction(self):
+        mu = 0
+        sd_prior = 1
+        prior_obs = 0.01
+        kappa = prior_obs
+        alpha = prior_obs/2
+        var_prior = sd_prior**2
+        tau_prior = 1/var_prior
+        beta = alpha/tau_prior
+
+        prior = np.array([mu, kappa, alpha, beta])
+
+        x = np.linspace(-np.pi/2, np.pi/2, 20)
+        y = np.linspace(-np.pi/2, np.pi/2, 20)
+        X = np.array([x, y]).T
+        y = np.sin(x) + 3*np.cos(y)
+
+        # large enough to be split up across threads
+        X_test = np.random.RandomState(666).uniform(-np.pi/2, np.pi/2, (5000, 2))
+
+        for data_matrix_transform in data_matrix_transforms:
+            for model in create_regression_trees(prior, 0.9):
+                print('Testing {}'.format(type(model).__name__))
+                model.fit(data_matrix_transform(X), y)
+                print(model)
+
+                X_test_transformed = data_matrix_transform(X_test)
+                assert_array_equal(model.predict(X_test_transformed, n_jobs=3), model.predict(X_test_transformed))
+                assert_array_equal(model.predict(X_test_transformed, n_jobs=None), model.predict(X_test_transformed))
+
+                # more threads than rows
+                with patch('bayesian_decision_tree.base.PARALLEL_PREDICTION_MIN_ROWS', 1):
+                    X_test_small = data_matrix_transform(X_test[:10])
+                    assert_array_equal(model.predict(X_test_small, n_jobs=20), model.predict(X_test_small))
+
+                for bad_n_jobs in [0, -2, 2.5, '2']:
+                    try:
+                        model.predict(X_test_transformed, n_jobs=bad_n_jobs)
+                        self.fail()
+                    except ValueError:
+                        pass
+
+    def test_posterior_of_split_nodes(self):
+        mu = 0
+        sd_prior = 1
+        prior_obs = 0.01
+        kappa = prior_obs
+        alpha = prior_obs/2
+        var_prior = sd_prior**2
+        tau_prior = 1/var_prior
+        beta = alpha/tau_prior
+
+        prior = np.array([mu, kappa, alpha, beta])
+
+        x = np.linspace(-np.pi/2, np.pi/2, 20)
+        y = np.linspace(-np.pi/2, np.pi/2, 20)
+        X = np.array([x, y]).T
+        y = np.sin(x) + 3*np.cos(y) + 10
+
+        for data_matrix_transform in data_matrix_transforms:
+            for model in create_regression_trees(prior, 0.9):
+                print('Testing {}'.format(type(model).__name__))
+                model.fit(data_matrix_transform(X), y)
+                print(model)
+
+                # the root's posterior is derived from those of its children but must match the one of all data
+                self.assertFalse(model.is_leaf())
+                assert_allclose(model.posterior, model._compute_posterior(y), rtol=1e-12)
+
+    def test_parallel_fit(self):
+        mu = 0
+        sd_prior = 1
+        prior_obs = 0.01
+        kappa = prior_obs
+        alpha = prior_obs/2
+        var_prior = sd_prior**2
+        tau_prior = 1/var_prior
+        beta = alpha/tau_prior
+
+        prior = np.array([mu, kappa, alpha, beta])
+
+        # large enough for subtrees to be fitted on other threads
+        X = np.random.RandomState(666).uniform(-np.pi/2, np.pi/2, (50000, 2))
+        y = np.sin(X[:, 0]) + 3*np.cos(X[:, 1])
+
+        for data_matrix_transform in data_matrix_transforms:
+            model = PerpendicularRegressionTree(0.9, prior)
+            model_parallel = PerpendicularRegressionTree(0.9, prior)
+            X_transformed = data_matrix_transform(X)
+            model.fit(X_transformed, y)
+            model_parallel.fit(X_transformed, y, n_jobs=3)
+
+            self.assertEqual(str(model_parallel), str(model))
+            assert_array_equal(model_parallel.predict(X_transformed), model.predict(X_transformed))
+
+        # fitting falls back to a single thread (with a warning) if the threading layer doesn't allow for more
+        model = PerpendicularRegressionTree(0.9, prior)
+        model_parallel = PerpendicularRegressionTree(0.9, prior)
+        model.fit(X, y)
+        with patch('bayesian_decision_tree.base_perpendicular.threading_layer', return_value='workqueue'):
+            with self.assertWarns(RuntimeWarning):
+                model_parallel.fit(X, y, n_jobs=3)
+
+        self.assertEqual(str(model_parallel), str(model))
+
+    def test_constant_dimensions(self):
+        mu = 0
+        sd_prior = 1
+        prior_obs = 0.01
+        kappa = prior_obs
+        alpha = prior_obs/2
+        var_prior = sd_prior**2
+        tau_prior = 1/var_prior
+        beta = alpha/tau_prior
+
+        prior = np.array([mu, kappa, alpha, beta])
+
+        x = np.linspace(-np.pi/2, np.pi/2, 20)
+        X = np.array([np.zeros(20), x, np.full(20, 5.0)]).T
+        y = np.sin(x)
+
+        for data_matrix_transform in data_matrix_transforms:
+            model = PerpendicularRegressionTree(0.9, prior)
+            model_varying_dimension_only = PerpendicularRegressionTree(0.9, prior)
+            model.fit(data_matrix_transform(X), y)
+            model_varying_dimension_only.fit(data_matrix_transform(X[:, [1]]), y)
+            print(model)
+
+            # dimensions that can't be split are skipped but still count towards the partition prior
+            self.assertEqual(model.split_dimension, 1)
+            self.assertEqual(len(model.feature_importance()), 3)
+            self.assertEqual(model.feature_importance()[[0, 2]].sum(), 0)
+            self.assertTrue(model.get_n_leaves() <= model_varying_dimension_only.get_n_leaves())
+            assert_array_equal(model.predict(data_matrix_transform(X)), model.predict(X))
+
+    def test_binned_fit(self):
+        mu = 0
+        sd_prior = 1
+        prior_obs = 0.01
+        kappa = prior_obs
+        alpha = prior_obs/2
+        var_prior = sd_prior**2
+        tau_prior = 1/var_prior
+        beta = alpha/tau_prior
+
+        prior = np.array([mu, kappa, alpha, beta])
+
+        X = np.random.RandomState(666).uniform(-np.pi/2, np.pi/2, (1000, 2))
+        y = np.sin(X[:, 0]) + 3*np.cos(X[:, 1])
+
+        model = PerpendicularRegressionTree(0.9, prior)
+        model.fit(X, y)
+
+        # with at least as many bins as different values binning changes nothing
+        model_binned = PerpendicularRegressionTree(0.9, prior)
+        model_binned.fit(X, y, max_bins=1000)
+        self.assertEqual(str(model_binned), str(model))
+
+        # binning preserves the order of the values
+        X_binned = PerpendicularRegressionTree._bin(X, 8)
+        for dim in range(2):
+            self.assertEqual(len(np.unique(X_binned[:, dim])), 8)
+            self.assertTrue(np.all(np.diff(X_binned[np.argsort(X[:, dim]), dim].astype(int)) >= 0))
+
+        model_binned.fit(X, y, max_bins=8)
+        print(model_binned)
+        self.assertTrue(mean_squared_error(y, model_binned.predict(X)) < 0.1*np.var(y))
+
+        for bad_max_bins in [1, 65537, 2.5, 16.0, True, '16']:
+            try:
+                model_binned.fit(X, y, max_bins=bad_max_bins)
+                self.fail()
+            except ValueError:
+                pass
+
+    def test_integer_targets_reach_kernels_as_float64(self):
+        mu = 0
+        sd_prior = 1
+        prior_obs = 0.01
+        kappa = prior_obs
+        alpha = prior_obs/2
+        var_prior = sd_prior**2
+        tau_prior = 1/var_prior
+        beta = alpha/tau_prior
+
+        prior = np.array([mu, kappa, alpha, beta])
+
+        X = np.random.RandomState(666).normal(0, 1, (100, 2))
+        for dtype in [np.int32, np.int64]:
+            y = np.round(10*X[:, 0]).astype(dtype)
+            with patch('bayesian_decision_tree.base_perpendicular.has_different_values',
+                       float64_only(kernels.has_different_values, 0)), \
+                    patch('bayesian_decision_tree.base_hyperplane.has_different_values',
+                          float64_only(kernels.has_different_values, 0)), \
+                    patch('bayesian_decision_tree.regression.log_p_data_split_regression',
+                          float64_only(kernels.log_p_data_split_regression, 0, 2)):
+                for model in create_regression_trees(prior, 0.5):
+                    print('Testing {}'.format(type(model).__name__))
+                    model.fit(X, y)
+
+    def test_sparse_data_with_negative_values_and_zeros(self):
+        mu = 0
+        sd_prior = 1
+        prior_obs = 0.01
+        kappa = prior_obs
+        alpha = prior_obs/2
+        var_prior = sd_prior**2
+        tau_prior = 1/var_prior
+        beta = alpha/tau_prior
+
+        prior = np.array([mu, kappa, alpha, beta])
+
+        # negative values, zeros and positive values (the sparse split search handles those three blocks
+        # separately) along with explicitly stored zeros
+        rng = np.random.RandomState(666)
+        X = np.round(rng.normal(0, 1, (1000, 3)), 1)
+        X[rng.uniform(size=X.shape) < 0.3] = 0
+        X_csc = csc_matrix(X)
+        X_csc.data[::7] = 0
+        X_csr = X_csc.tocsr()
+        X = X_csc.toarray()
+        self.assertTrue(np.any(X_csc.data == 0) and np.any(X_csr.data == 0))
+        y = np.sign(X[:, 0]) + 2*(X[:, 1] == 0) + X[:, 2] + 0.1*rng.normal(0, 1, 1000)
+
+        model = PerpendicularRegressionTree(0.9, prior)
+        model.fit(X, y)
+        print(model)
+        for X_sparse in [X_csc, X_csr]:
+            model_sparse = PerpendicularRegressionTree(0.9, prior)
+            model_sparse.fit(X_sparse, y)
+            self.assertEqual(str(model_sparse), str(model))
+            assert_array_equal(model_sparse.predict(X_sparse), model.predict(X))
+
+    def test_log_p_data_split(self):
+        mu = 0
+        sd_prior = 1
+        prior_obs = 0.01
+        kappa = prior_obs
+        alpha = prior_obs/2
+        var_prior = sd_prior**2
+        tau_prior = 1/var_prior
+        beta = alpha/tau_prior
+
+        prior = np.array([mu, kappa, alpha, beta])
+
+        # the split kernel derives the children's statistics from cumulative sums, which must match computing
+        # each child's posterior and data likelihood from its own data (far away from 0 to catch cancellation)
+        model = PerpendicularRegressionTree(0.9, prior)
+        y = 1000 + np.random.RandomState(666).normal(0, 1, 50)
+        split_indices = np.arange(1, len(y))
+        log_p_prior = -3.0
+
+        log_p_data_split = kernels.log_p_data_split_regression(y, split_indices, prior, log_p_prior)
+
+        expected = []
+        for i in split_indices:
+            log_p_data = log_p_prior
+            for y_child in [y[:i], y[i:]]:
+                n = len(y_child)
+                mean = y_child.mean()
+                y_minus_mean_sq_sum = ((y_child - mean)**2).sum()
+                _, kappa_post, alpha_post, beta_post = model._compute_posterior_internal(n, mean, y_minus_mean_sq_sum)
+                log_p_data += model._compute_log_p_data(alpha_post, beta_post, kappa_post, n)
+
+            expected.append(log_p_data)
+
+        assert_allclose(log_p_data_split, expected, rtol=1e-12)
+
+    def test_nan_values_go_to_rhs(self):
+        mu = 0
+        sd_prior = 1
+        prior_obs = 0.01
+        kappa = prior_obs
+        alpha = prior_obs/2
+        var_prior = sd_prior**2
+        tau_prior = 1/var_prior
+        beta = alpha/tau_prior
+
+        prior = np.array([mu, kappa, alpha, beta])
+
+        x = np.linspace(-np.pi/2, np.pi/2, 20)
+        y = np.linspace(-np.pi/2, np.pi/2, 20)
+        X = np.array([x, y]).T
+        y = np.sin(x) + 3*np.cos(y)
+
+        # rows with NaN in a split dimension aren't less than the split value, so they are predicted like rows
+        # with infinitely large values there
+        X_test = np.random.RandomState(666).uniform(-np.pi/2, np.pi/2, (100, 2))
+        X_test[::3, 0] = np.nan
+        X_test[::4, 1] = np.nan
+        X_test_inf = np.nan_to_num(X_test, nan=np.inf)
+
+        for data_matrix_transform in data_matrix_transforms:
+            model = PerpendicularRegressionTree(0.9, prior)
+            model.fit(data_matrix_transform(X), y)
+            print(model)
+
+            prediction = model.predict(data_matrix_transform(X_test))
+            assert_array_equal(prediction, model.predict(data_matrix_transform(X_test_inf)))
+            self.assertTrue(np.all(prediction != 0))
+
+    def test_predict_without_flat_tree(self):
+        mu = 0
+        sd_prior = 1
+        prior_obs = 0.01
+        kappa = prior_obs
+        alpha = prior_obs/2
+        var_prior = sd_prior**2
+        tau_prior = 1/var_prior
+        beta = alpha/tau_prior
+
+        prior = np.array([mu, kappa, alpha, beta])
+
+        x = np.linspace(-np.pi/2, np.pi/2, 20)
+        y = np.linspace(-np.pi/2, np.pi/2, 20)
+        X = np.array([x, y]).T
+        y = np.sin(x) + 3*np.cos(y)
+
+        model = PerpendicularRegressionTree(0.9, prior)
+        model.fit(X, y)
+        prediction = model.predict(X)
+        prediction_paths = model.prediction_paths(X)
+
+        # models pickled with version 0.2 don't have a flattened tree
+        for node in model._get_nodes():
+            del node._flat_tree
+
+        model = pickle.loads(pickle.dumps(model))
+        assert_array_equal(model.predict(X), prediction)
+        self.assertEqual(model.prediction_paths(X), prediction_paths)